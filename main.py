@@ -1,9 +1,13 @@
-import os, json, time, logging, datetime as dt, uuid, base64, random
-from typing import List, Dict, Any, Optional, Tuple, Iterable
+import os, json, time, logging, datetime as dt, uuid, base64, random, asyncio, functools, threading, queue, contextlib
+from logging.handlers import QueueHandler, QueueListener
+from collections import deque
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator, Deque, Iterator
 
-from fastapi import FastAPI, HTTPException, Request, Depends
+from fastapi import FastAPI, HTTPException, Request, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.datastructures import Headers, MutableHeaders
 from pydantic import BaseModel, Field, ConfigDict
 
 from dotenv import load_dotenv
@@ -14,6 +18,11 @@ from google.analytics.data_v1beta.types import (
     RunReportRequest, DateRange, Dimension, Metric, OrderBy
 )
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson es opcional
+    orjson = None
+
 # ------------------------------ Config ---------------------------------------
 load_dotenv()
 
@@ -23,11 +32,53 @@ logging.basicConfig(
 )
 log = logging.getLogger("dashmarketing")
 
-def _dumps(obj) -> bytes:
-    """Serializa a JSON (bytes) sin orjson."""
-    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
-
-app = FastAPI(title="Dash Marketing API", version="1.2.1")
+# Con el listener activo, los handlers del root logger escriben desde un hilo
+# aparte; el mensaje se sigue formateando en el hilo que loguea (QueueHandler.prepare).
+_log_listener: Optional[QueueListener] = None
+
+def _start_log_listener() -> None:
+    global _log_listener
+    if _log_listener is not None:
+        return
+    root = logging.getLogger()
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    _log_listener = QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [QueueHandler(log_queue)]
+    _log_listener.start()
+
+def _stop_log_listener() -> None:
+    global _log_listener
+    if _log_listener is None:
+        return
+    _log_listener.stop()
+    logging.getLogger().handlers = list(_log_listener.handlers)
+    _log_listener = None
+
+@contextlib.asynccontextmanager
+async def _lifespan(_: FastAPI):
+    _start_log_listener()
+    try:
+        yield
+    finally:
+        _stop_log_listener()
+
+def _json_default(o):
+    if isinstance(o, (dt.date, dt.datetime)):
+        return o.isoformat()
+    return str(o)
+
+if orjson is not None:
+    def _dumps(obj) -> bytes:
+        """Serializa a JSON (bytes) con orjson."""
+        return orjson.dumps(obj, default=_json_default)
+else:
+    def _dumps(obj) -> bytes:
+        """Serializa a JSON (bytes) sin orjson."""
+        return json.dumps(
+            obj, separators=(",", ":"), ensure_ascii=False, default=_json_default
+        ).encode("utf-8")
+
+app = FastAPI(title="Dash Marketing API", version="1.2.1", lifespan=_lifespan)
 
 ENV = os.getenv("ENV", "development")
 allowed_origins = [o.strip() for o in os.getenv("ALLOWED_ORIGINS", "").split(",") if o.strip()]
@@ -40,6 +91,11 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=int(os.getenv("GZIP_MIN_SIZE", "1024")),
+    compresslevel=int(os.getenv("GZIP_LEVEL", "5")),
+)
 
 PROPERTY_ID = os.getenv("GA4_PROPERTY_ID", "279889272")
 GA4_JSON_KEY_PATH = os.getenv("GA4_JSON_KEY_PATH", "/etc/secrets/ga4-credentials.json")
@@ -47,77 +103,102 @@ GA4_JSON_KEY_BASE64 = os.getenv("GA4_JSON_KEY_BASE64")
 MIN_START_DATE = dt.date(2024, 1, 1)
 GA4_TIMEOUT_SECONDS = float(os.getenv("GA4_TIMEOUT_SECONDS", "60"))
 GA4_MAX_RETRIES = int(os.getenv("GA4_MAX_RETRIES", "3"))
+GA4_MONTH_CONCURRENCY = max(1, int(os.getenv("GA4_MONTH_CONCURRENCY", "4")))
+AGG_CACHE_TTL_SECONDS = float(os.getenv("AGG_CACHE_TTL_SECONDS", "3600"))
+AGG_CACHE_MAXSIZE = 512
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", str(64 * 1024)))
+STREAM_FLUSH_ROWS = int(os.getenv("STREAM_FLUSH_ROWS", "256"))
 
 # ------------------------------ Utils ----------------------------------------
-def _ga4_client() -> BetaAnalyticsDataClient:
-    info: Dict[str, Any]
+@functools.lru_cache(maxsize=1)
+def _ga4_credentials_info() -> Dict[str, Any]:
     if GA4_JSON_KEY_BASE64:
-        info = json.loads(base64.b64decode(GA4_JSON_KEY_BASE64))
-    else:
-        path = GA4_JSON_KEY_PATH or "/etc/secrets/ga4-credentials.json"
-        if not os.path.exists(path):
-            path = "/etc/secrets/ga4-credentials.json"
-        if not os.path.exists(path):
-            raise HTTPException(status_code=500, detail=f"GA4 credentials not found at {path}")
-        with open(path, "r") as fh:
-            info = json.load(fh)
-    creds = service_account.Credentials.from_service_account_info(info)
+        return json.loads(base64.b64decode(GA4_JSON_KEY_BASE64))
+    path = GA4_JSON_KEY_PATH or "/etc/secrets/ga4-credentials.json"
+    if not os.path.exists(path):
+        path = "/etc/secrets/ga4-credentials.json"
+    if not os.path.exists(path):
+        raise HTTPException(status_code=500, detail=f"GA4 credentials not found at {path}")
+    with open(path, "r") as fh:
+        return json.load(fh)
+
+@functools.lru_cache(maxsize=1)
+def _ga4_client() -> BetaAnalyticsDataClient:
+    """Cliente GA4 compartido por proceso (el canal gRPC es thread-safe).
+
+    Si se rotan las credenciales hay que reiniciar el proceso.
+    """
+    creds = service_account.Credentials.from_service_account_info(_ga4_credentials_info())
     return BetaAnalyticsDataClient(credentials=creds)
 
 def _parse_date(s: str) -> dt.date:
+    # Formato fijo: se parsea a mano en lugar de pasar por strptime.
     try:
-        return dt.datetime.strptime(s, "%Y-%m-%d").date()
+        if (
+            len(s) == 10 and s.isascii() and s[4] == "-" and s[7] == "-"
+            and (s[:4] + s[5:7] + s[8:]).isdigit()
+        ):
+            return dt.date(int(s[0:4]), int(s[5:7]), int(s[8:10]))
     except Exception:
-        raise HTTPException(status_code=400, detail=f"Invalid date format: {s}. Expected YYYY-MM-DD")
+        pass
+    raise HTTPException(status_code=400, detail=f"Invalid date format: {s}. Expected YYYY-MM-DD")
 
-def _clamp_dates(start: str, end: str) -> Tuple[str, str]:
+def _clamp_dates(start: str, end: str) -> Tuple[dt.date, dt.date]:
     s = max(_parse_date(start), MIN_START_DATE)
     e_req = _parse_date(end)
     e = min(e_req, dt.date.today() - dt.timedelta(days=1))
     if s > e:
         raise HTTPException(status_code=400, detail=f"Invalid range after clamp: {s} > {e}")
-    return s.isoformat(), e.isoformat()
-
-def _dims() -> List[Dimension]:
-    return [
-        Dimension(name="date"),
-        Dimension(name="country"),
-        Dimension(name="city"),
-        Dimension(name="deviceCategory"),
-        Dimension(name="pagePath"),
-        Dimension(name="sessionSource"),
-        Dimension(name="sessionMedium"),
-        Dimension(name="sessionCampaignName"),
-    ]
-
-def _mets() -> List[Metric]:
-    return [
-        Metric(name="activeUsers"),
-        Metric(name="newUsers"),
-        Metric(name="sessions"),
-        Metric(name="screenPageViews"),
-        Metric(name="engagementRate"),
-        Metric(name="bounceRate"),
-        Metric(name="averageSessionDuration"),
-        Metric(name="conversions"),
-        Metric(name="totalRevenue"),
-    ]
-
-def _stable_order() -> List[OrderBy]:
-    return [OrderBy(dimension=OrderBy.DimensionOrderBy(dimension_name=d.name)) for d in _dims()]
-
-def _month_range_iter(start: dt.date, end: dt.date) -> List[dt.date]:
-    cur = start.replace(day=1)
-    out = []
-    while cur <= end:
-        out.append(cur)
-        year = cur.year + (cur.month // 12)
-        month = (cur.month % 12) + 1
-        cur = dt.date(year, month, 1)
-    return out
+    return s, e
+
+# Dimensiones/métricas del detalle: se construyen una sola vez al importar.
+_DIM_NAMES = (
+    "date",
+    "country",
+    "city",
+    "deviceCategory",
+    "pagePath",
+    "sessionSource",
+    "sessionMedium",
+    "sessionCampaignName",
+)
+_MET_NAMES = (
+    "activeUsers",
+    "newUsers",
+    "sessions",
+    "screenPageViews",
+    "engagementRate",
+    "bounceRate",
+    "averageSessionDuration",
+    "conversions",
+    "totalRevenue",
+)
+_DIMS: List[Dimension] = [Dimension(name=n) for n in _DIM_NAMES]
+_METS: List[Metric] = [Metric(name=n) for n in _MET_NAMES]
+_STABLE_ORDER: List[OrderBy] = [
+    OrderBy(dimension=OrderBy.DimensionOrderBy(dimension_name=n)) for n in _DIM_NAMES
+]
+
+def _month_range_iter(start: dt.date, end: dt.date) -> Iterator[Tuple[dt.date, dt.date]]:
+    """Genera (inicio, fin) de cada mes entre start y end, ya recortados al rango."""
+    y, m = start.year, start.month
+    while (y, m) <= (end.year, end.month):
+        ny, nm = (y + 1, 1) if m == 12 else (y, m + 1)
+        m_start = dt.date(y, m, 1)
+        m_end = dt.date(ny, nm, 1) - dt.timedelta(days=1)
+        yield max(m_start, start), min(m_end, end)
+        y, m = ny, nm
+
+# Métricas sumadas para la auditoría.
+_SUM_NAMES = ("sessions", "activeUsers", "screenPageViews", "conversions", "totalRevenue")
+
+# Caché TTL de _agg_totals. _clamp_dates limita el fin a ayer, así que los rangos
+# consultados son datos ya cerrados y pueden reutilizarse entre refrescos.
+_agg_cache: Dict[bytes, Tuple[float, Dict[str, float]]] = {}
+_agg_cache_lock = threading.Lock()
 
 def _agg_totals(client: BetaAnalyticsDataClient, detail_req: RunReportRequest) -> Dict[str, float]:
-    names = ["sessions", "activeUsers", "screenPageViews", "conversions", "totalRevenue"]
+    names = list(_SUM_NAMES)
     req = RunReportRequest(
         property=detail_req.property,
         date_ranges=detail_req.date_ranges,
@@ -127,59 +208,153 @@ def _agg_totals(client: BetaAnalyticsDataClient, detail_req: RunReportRequest) -
         metrics=[Metric(name=m) for m in names],
         limit=1,
     )
-    resp = client.run_report(req)
+    key = RunReportRequest.serialize(req)
+    now = time.monotonic()
+    with _agg_cache_lock:
+        hit = _agg_cache.get(key)
+    if hit is not None and hit[0] > now:
+        return dict(hit[1])
+
+    resp = client.run_report(req, timeout=GA4_TIMEOUT_SECONDS)
     out = {m: 0.0 for m in names}
     if resp.rows:
         mv = resp.rows[0].metric_values
         for i, m in enumerate(names):
             val = mv[i].value
             out[m] = float(val) if (val is not None and val != "") else 0.0
+
+    if AGG_CACHE_TTL_SECONDS > 0:
+        with _agg_cache_lock:
+            if len(_agg_cache) >= AGG_CACHE_MAXSIZE:
+                for k in [k for k, (exp, _) in _agg_cache.items() if exp <= now]:
+                    del _agg_cache[k]
+                if len(_agg_cache) >= AGG_CACHE_MAXSIZE:
+                    del _agg_cache[next(iter(_agg_cache))]
+            _agg_cache[key] = (now + AGG_CACHE_TTL_SECONDS, dict(out))
     return out
 
 # -------------------------- Streaming helpers --------------------------------
-def _row_to_dict(row, dims: List[Dimension], mets: List[Metric]) -> Dict[str, Any]:
-    d = {dims[i].name: row.dimension_values[i].value for i in range(len(dims))}
-    for j in range(len(mets)):
-        val = row.metric_values[j].value
-        d[mets[j].name] = float(val) if (val is not None and val != "") else None
-    return d
+# Prefijos JSON precalculados de cada campo ('{"date":', ',"country":', ...): evitan
+# construir un dict y re-codificar las claves por fila.
+_DIM_KEYS = tuple(
+    (("{" if i == 0 else ",") + f'"{n}":').encode("utf-8") for i, n in enumerate(_DIM_NAMES)
+)
+_MET_KEYS = tuple(f',"{n}":'.encode("utf-8") for n in _MET_NAMES)
+# Para cada métrica, su posición en los totales de auditoría (None si no se suma).
+_MET_SUM_SLOT = tuple(_SUM_NAMES.index(n) if n in _SUM_NAMES else None for n in _MET_NAMES)
+
+def _emit_row(row, out: bytearray, totals: List[float]) -> None:
+    """Serializa una fila GA4 en ``out`` y suma sus métricas de auditoría en ``totals``.
+
+    Las métricas llegan como strings decimales ya validados por GA4, así que se
+    emiten tal cual (o ``null`` si vienen vacías); solo las de _SUM_NAMES pasan
+    por ``float``.
+    """
+    for key, v in zip(_DIM_KEYS, row.dimension_values):
+        out += key
+        out += _dumps(v.value)
+    for key, slot, v in zip(_MET_KEYS, _MET_SUM_SLOT, row.metric_values):
+        out += key
+        val = v.value
+        if val:
+            out += val.encode("ascii")
+            if slot is not None:
+                totals[slot] += float(val)
+        else:
+            out += b"null"
+    out += b"}"
+
+def _start_agg_totals(client: BetaAnalyticsDataClient, detail_req: RunReportRequest) -> asyncio.Task:
+    """Lanza _agg_totals en un hilo para solaparla con la paginación del detalle."""
+    return asyncio.create_task(asyncio.to_thread(_agg_totals, client, detail_req))
+
+async def _cancel_tasks(tasks: List[asyncio.Task]) -> None:
+    """Cancela ``tasks`` y recoge sus excepciones (evita "Task exception was never retrieved").
+
+    Las llamadas a GA4 que ya corren en un hilo (asyncio.to_thread) no se
+    interrumpen: terminan por su cuenta y su resultado se descarta.
+    """
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 def _pct_diff(a: float, b: float) -> float:
     return 0.0 if (b or 0.0) == 0.0 else (a - b) / b
 
 
 # ------------------------------ Middleware -----------------------------------
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    rid = request.headers.get("X-Request-ID", str(uuid.uuid4()))
-    start = time.time()
-    request.state.request_id = rid
-    response = await call_next(request)
-    duration = time.time() - start
-    log.info("%s %s %s %d %.3fs", rid, request.method, request.url.path, response.status_code, duration)
-    response.headers["X-Request-ID"] = rid
-    return response
+class LogRequestsASGI:
+    """Registra cada petición y añade X-Request-ID.
+
+    Es ASGI puro (no ``BaseHTTPMiddleware``) para no bufferizar las respuestas en
+    streaming: solo toca ``http.response.start`` y deja pasar el cuerpo tal cual.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        rid = Headers(scope=scope).get("X-Request-ID") or str(uuid.uuid4())
+        scope.setdefault("state", {})["request_id"] = rid
+        start = time.time()
+        status: Optional[int] = None
+        completed = False
+
+        async def _send(message):
+            nonlocal status, completed
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                MutableHeaders(scope=message)["X-Request-ID"] = rid
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                completed = True
+            await send(message)
+
+        # Se loguea siempre, también si el stream falla a mitad o el cliente corta:
+        # es la línea que lleva el rid para cruzarla con los intentos de _run_report.
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            duration = time.time() - start
+            log.info(
+                "%s %s %s %d %.3fs%s",
+                rid,
+                scope["method"],
+                scope["path"],
+                status if status is not None else 500,
+                duration,
+                "" if completed else " aborted",
+            )
+
+app.add_middleware(LogRequestsASGI)
 
 
 # ------------------------------ Retries --------------------------------------
+# Espera base (s) por intento fallido; de ahí en adelante se mantiene en 60s.
+_BACKOFF = (1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 60.0)
+
 def _run_report(client: BetaAnalyticsDataClient, req: RunReportRequest, request_id: str):
     for attempt in range(1, GA4_MAX_RETRIES + 1):
         try:
             resp = client.run_report(req, timeout=GA4_TIMEOUT_SECONDS)
-            log.info(json.dumps({"attempt": attempt, "status": 200, "sleep_ms": 0, "request_id": request_id}))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("attempt=%d status=%s sleep_ms=%d rid=%s", attempt, 200, 0, request_id)
             return resp
         except Exception as exc:
             status = getattr(getattr(exc, "response", None), "status_code", None) or getattr(exc, "code", None)
             retry_after = None
             if hasattr(exc, "response") and getattr(exc, "response", None):
                 retry_after = exc.response.headers.get("Retry-After")
-            sleep = min(2 ** (attempt - 1) + random.random(), 60)
+            sleep = min(_BACKOFF[min(attempt, len(_BACKOFF)) - 1] + random.random(), 60)
             if retry_after:
                 try:
                     sleep = max(sleep, float(retry_after))
                 except ValueError:
                     pass
-            log.info(json.dumps({"attempt": attempt, "status": status, "sleep_ms": int(sleep * 1000), "request_id": request_id}))
+            log.info("attempt=%d status=%s sleep_ms=%d rid=%s", attempt, status, int(sleep * 1000), request_id)
             if attempt == GA4_MAX_RETRIES:
                 raise
             time.sleep(sleep)
@@ -208,14 +383,38 @@ class ExportarParams(BaseModel):
         alias="maxPages",
         description="Safety cap; 0 or None = no limit",
     )
+    audit: bool = Field(
+        False,
+        description="Include the audit block (extra aggregate GA4 query); always included when partial",
+    )
 
     model_config = ConfigDict(populate_by_name=True)
 
 
+def _exportar_params(
+    start: str = Query(..., alias="from", description="YYYY-MM-DD"),
+    end: str = Query(..., alias="to", description="YYYY-MM-DD"),
+    page_size: int = Query(1000, ge=1, alias="pageSize", description="Rows per page"),
+    max_pages: Optional[int] = Query(
+        0, ge=0, le=2000, alias="maxPages", description="Safety cap; 0 or None = no limit"
+    ),
+    audit: bool = Query(
+        False,
+        description="Include the audit block (extra aggregate GA4 query); always included when partial",
+    ),
+) -> ExportarParams:
+    # `from` es palabra reservada: con Depends() sobre el modelo, FastAPI expondría el
+    # parámetro como `start`. Los alias se declaran aquí explícitamente.
+    return ExportarParams(
+        start=start, end=end, page_size=page_size, max_pages=max_pages, audit=audit
+    )
+
+
 @app.get("/exportar")
-def exportar_datos(request: Request, params: ExportarParams = Depends()):
+def exportar_datos(request: Request, params: ExportarParams = Depends(_exportar_params)):
     """Exporta con streaming para no usar memoria: emite {"rows":[ ... ], meta...}"""
-    s_iso, e_iso = _clamp_dates(params.start, params.end)
+    s, e = _clamp_dates(params.start, params.end)
+    s_iso, e_iso = s.isoformat(), e.isoformat()
     page_size = params.page_size
     max_pages = params.max_pages
     rid = getattr(request.state, "request_id", str(uuid.uuid4()))
@@ -224,109 +423,124 @@ def exportar_datos(request: Request, params: ExportarParams = Depends()):
     )
 
     client = _ga4_client()
-    dims = _dims()
-    mets = _mets()
-
 
     effective_limit = min(page_size, 100000)
     req = RunReportRequest(
         property=f"properties/{PROPERTY_ID}",
         date_ranges=[DateRange(start_date=s_iso, end_date=e_iso)],
-        dimensions=dims,
-        metrics=mets,
-        order_bys=_stable_order(),
+        dimensions=_DIMS,
+        metrics=_METS,
+        order_bys=_STABLE_ORDER,
         limit=effective_limit,
     )
+    detail_req = RunReportRequest(
+        property=f"properties/{PROPERTY_ID}",
+        date_ranges=[DateRange(start_date=s_iso, end_date=e_iso)],
+        dimensions=_DIMS,
+        metrics=_METS,
+    )
 
     pages = 0
     total_rows_reported: Optional[int] = None
-    sum_sessions = sum_users = sum_views = sum_conv = sum_rev = 0.0
-
-    def _gen() -> Iterable[bytes]:
-        nonlocal pages, total_rows_reported, sum_sessions, sum_users, sum_views, sum_conv, sum_rev
-        yield b'{"rows":['
-        first = True
-        page_token: Optional[str] = None
-        offset = 0
-        while True:
-            req.page_token = page_token
-            req.offset = offset
-            resp = _run_report(client, req, rid)
-            if total_rows_reported is None:
-                total_rows_reported = getattr(resp, "row_count", None)
-            batch_count = 0
+    totals = [0.0] * len(_SUM_NAMES)
 
-            for r in resp.rows:
-                d = _row_to_dict(r, dims, mets)
-                sum_sessions += d.get("sessions") or 0.0
-                sum_users    += d.get("activeUsers") or 0.0
-                sum_views    += d.get("screenPageViews") or 0.0
-                sum_conv     += d.get("conversions") or 0.0
-                sum_rev      += d.get("totalRevenue") or 0.0
-
-                if not first:
-                    yield b","
-                else:
-                    first = False
-                yield _dumps(d)
-                batch_count += 1
+    async def _gen() -> AsyncIterator[bytes]:
+        nonlocal pages, total_rows_reported
+        agg_task = _start_agg_totals(client, detail_req) if params.audit else None
+        try:
+            yield b'{"rows":['
+            first = True
+            buf = bytearray()
+            rows_in_buf = 0
+            offset = 0
+            while True:
+                req.offset = offset
+                resp = await asyncio.to_thread(_run_report, client, req, rid)
+                if total_rows_reported is None:
+                    total_rows_reported = getattr(resp, "row_count", None)
+                batch_count = 0
 
-            if batch_count == 0:
-                break
+                for r in resp.rows:
+                    if not first:
+                        buf += b","
+                    else:
+                        first = False
+                    _emit_row(r, buf, totals)
+                    batch_count += 1
+                    rows_in_buf += 1
+                    if rows_in_buf >= STREAM_FLUSH_ROWS or len(buf) >= STREAM_FLUSH_BYTES:
+                        yield bytes(buf)
+                        buf.clear()
+                        rows_in_buf = 0
+                # Lo pendiente de la página se envía antes de pedir la siguiente.
+                if buf:
+                    yield bytes(buf)
+                    buf.clear()
+                    rows_in_buf = 0
 
-            pages += 1
-            page_token = getattr(resp, "next_page_token", None)
-            if page_token:
-                offset = 0
-            else:
+                if batch_count == 0:
+                    break
+
+                pages += 1
+                # RunReportRequest (v1beta) no tiene page_token: se pagina solo con offset.
                 offset += batch_count
-            if total_rows_reported is not None and offset >= total_rows_reported:
-                break
+                if total_rows_reported is not None and offset >= total_rows_reported:
+                    break
+
+                await asyncio.sleep(0.12)
+
+            yield b"],"
+            sum_sessions, sum_users, sum_views, sum_conv, sum_rev = totals
 
-            time.sleep(0.12)
-
-        yield b"],"
-
-        partial = False
-        reason: Optional[str] = None
-        if total_rows_reported is not None and offset < (total_rows_reported or 0):
-            partial = True
-            reason = "ga4_limit"
-
-        agg = _agg_totals(client, req)
-        diff = {
-            "sessions": _pct_diff(sum_sessions, agg.get("sessions", 0.0)),
-            "activeUsers": _pct_diff(sum_users, agg.get("activeUsers", 0.0)),
-            "screenPageViews": _pct_diff(sum_views, agg.get("screenPageViews", 0.0)),
-            "conversions": _pct_diff(sum_conv, agg.get("conversions", 0.0)),
-            "totalRevenue": _pct_diff(sum_rev, agg.get("totalRevenue", 0.0)),
-        }
-        body_tail = {
-            "rowCount": total_rows_reported,
-            "start": s_iso,
-            "end": e_iso,
-            "pages": pages,
-            "partial": partial,
-            "audit": {
-                "detail_totals": {
-                    "sessions": sum_sessions,
-                    "activeUsers": sum_users,
-                    "screenPageViews": sum_views,
-                    "conversions": sum_conv,
-                    "totalRevenue": sum_rev,
-                },
-                "ga4_aggregate": agg,
-                "diff_pct": diff,
+            partial = False
+            reason: Optional[str] = None
+            if total_rows_reported is not None and offset < (total_rows_reported or 0):
+                partial = True
+                reason = "ga4_limit"
+
+            body_tail: Dict[str, Any] = {
                 "rowCount": total_rows_reported,
+                "start": s_iso,
+                "end": e_iso,
                 "pages": pages,
                 "partial": partial,
-            },
-        }
-        if reason:
-            body_tail["reason"] = reason
-            body_tail["audit"]["reason"] = reason
-        yield _dumps(body_tail)
-        yield b"}"
+                "audit": None,
+            }
+            # Una exportación parcial siempre lleva la auditoría, aunque no se pidiera.
+            if agg_task is None and partial:
+                agg_task = _start_agg_totals(client, detail_req)
+            if agg_task is not None:
+                agg = await agg_task
+                diff = {
+                    "sessions": _pct_diff(sum_sessions, agg.get("sessions", 0.0)),
+                    "activeUsers": _pct_diff(sum_users, agg.get("activeUsers", 0.0)),
+                    "screenPageViews": _pct_diff(sum_views, agg.get("screenPageViews", 0.0)),
+                    "conversions": _pct_diff(sum_conv, agg.get("conversions", 0.0)),
+                    "totalRevenue": _pct_diff(sum_rev, agg.get("totalRevenue", 0.0)),
+                }
+                body_tail["audit"] = {
+                    "detail_totals": {
+                        "sessions": sum_sessions,
+                        "activeUsers": sum_users,
+                        "screenPageViews": sum_views,
+                        "conversions": sum_conv,
+                        "totalRevenue": sum_rev,
+                    },
+                    "ga4_aggregate": agg,
+                    "diff_pct": diff,
+                    "rowCount": total_rows_reported,
+                    "pages": pages,
+                    "partial": partial,
+                }
+            if reason:
+                body_tail["reason"] = reason
+                if body_tail["audit"] is not None:
+                    body_tail["audit"]["reason"] = reason
+            # El tail aporta sus miembros al objeto abierto con '{"rows":[': se omite su '{'.
+            yield _dumps(body_tail)[1:]
+        finally:
+            if agg_task is not None:
+                await _cancel_tasks([agg_task])
 
     return StreamingResponse(_gen(), media_type="application/json")
 
@@ -335,123 +549,137 @@ class ExportarMensualParams(BaseModel):
     end: str = Field(..., description="YYYY-MM-DD")
     page_size: int = Field(8000, ge=1000, le=25000)
     sleep_ms: int = Field(120, ge=0, le=2000, description="Backoff ms")
+    audit: bool = Field(False, description="Include the audit block (extra aggregate GA4 query)")
 
 
 @app.get("/exportar_mensual")
 def exportar_mensual(request: Request, params: ExportarMensualParams = Depends()):
-    """Streaming por meses para rangos grandes. No acumula filas en memoria."""
-    s_iso, e_iso = _clamp_dates(params.start, params.end)
-    s = _parse_date(s_iso)
-    e = _parse_date(e_iso)
+    """Streaming por meses para rangos grandes. Solo retiene en memoria los meses en vuelo."""
+    s, e = _clamp_dates(params.start, params.end)
+    s_iso, e_iso = s.isoformat(), e.isoformat()
     page_size = params.page_size
     sleep_ms = params.sleep_ms
     rid = getattr(request.state, "request_id", str(uuid.uuid4()))
     log.info(f"/exportar_mensual start={s_iso} end={e_iso} page_size={page_size}")
 
     client = _ga4_client()
-    dims = _dims()
-    mets = _mets()
     detail_req = RunReportRequest(
         property=f"properties/{PROPERTY_ID}",
         date_ranges=[DateRange(start_date=s_iso, end_date=e_iso)],
-        dimensions=dims,
-        metrics=mets,
+        dimensions=_DIMS,
+        metrics=_METS,
     )
 
     pages_total = 0
-    sum_sessions = sum_users = sum_views = sum_conv = sum_rev = 0.0
-    months = _month_range_iter(s, e)
-
-    def _gen() -> Iterable[bytes]:
-        nonlocal pages_total, sum_sessions, sum_users, sum_views, sum_conv, sum_rev
-        yield b'{"rows":['
-        first_row = True
-
-        for m0 in months:
-            m_start = m0
-            y2 = m0.year + (m0.month // 12)
-            m2 = (m0.month % 12) + 1
-            m_end = (dt.date(y2, m2, 1) - dt.timedelta(days=1))
-            if m_end > e: m_end = e
-            if m_start < s: m_start = s
-            if m_start > m_end: continue
-
-            effective_limit = min(page_size, 100000)
-            req = RunReportRequest(
-                property=f"properties/{PROPERTY_ID}",
-                date_ranges=[DateRange(start_date=m_start.isoformat(), end_date=m_end.isoformat())],
-                dimensions=dims,
-                metrics=mets,
-                order_bys=_stable_order(),
-                limit=effective_limit,
-                offset=0,
-            )
+    totals = [0.0] * len(_SUM_NAMES)
+
+    async def _fetch_month(m_start: dt.date, m_end: dt.date) -> bytes:
+        """Descarga todas las páginas de un mes y devuelve sus filas ya serializadas."""
+        nonlocal pages_total
+        effective_limit = min(page_size, 100000)
+        req = RunReportRequest(
+            property=f"properties/{PROPERTY_ID}",
+            date_ranges=[DateRange(start_date=m_start.isoformat(), end_date=m_end.isoformat())],
+            dimensions=_DIMS,
+            metrics=_METS,
+            order_bys=_STABLE_ORDER,
+            limit=effective_limit,
+            offset=0,
+        )
+        buf = bytearray()
+        while True:
+            resp = await asyncio.to_thread(_run_report, client, req, rid)
+            batch_count = 0
+            for r in resp.rows:
+                if buf:
+                    buf += b","
+                _emit_row(r, buf, totals)
+                batch_count += 1
 
-            while True:
-                resp = _run_report(client, req, rid)
-                batch_count = 0
-                for r in resp.rows:
-                    d = _row_to_dict(r, dims, mets)
+            if batch_count == 0:
+                break
+            pages_total += 1
 
-                    sum_sessions += d.get("sessions") or 0.0
-                    sum_users    += d.get("activeUsers") or 0.0
-                    sum_views    += d.get("screenPageViews") or 0.0
-                    sum_conv     += d.get("conversions") or 0.0
-                    sum_rev      += d.get("totalRevenue") or 0.0
+            total_month = getattr(resp, "row_count", None)
+            if total_month is not None and req.offset + batch_count >= total_month:
+                req.offset += batch_count
+                break
 
-                    if not first_row:
-                        yield b","
-                    else:
-                        first_row = False
-                    yield _dumps(d)
-                    batch_count += 1
+            req.offset += batch_count
+            if sleep_ms:
+                await asyncio.sleep(sleep_ms / 1000.0)
+        return bytes(buf)
 
-                if batch_count == 0:
-                    break
-                pages_total += 1
+    async def _gen() -> AsyncIterator[bytes]:
+        agg_task = _start_agg_totals(client, detail_req) if params.audit else None
+        pending: Deque[asyncio.Task] = deque()
+        try:
+            yield b'{"rows":['
+            first_row = True
+
+            # Ventana deslizante: como mucho GA4_MONTH_CONCURRENCY meses en vuelo, y
+            # se emiten en orden de mes para que la salida sea determinista.
+            remaining = _month_range_iter(s, e)
+
+            def _schedule_next() -> None:
+                nxt = next(remaining, None)
+                if nxt is not None:
+                    pending.append(asyncio.create_task(_fetch_month(*nxt)))
+
+            for _ in range(GA4_MONTH_CONCURRENCY):
+                _schedule_next()
+            while pending:
+                chunk = await pending.popleft()
+                _schedule_next()
+                if not chunk:
+                    continue
+                if not first_row:
+                    yield b","
+                else:
+                    first_row = False
+                yield chunk
 
-                total_month = getattr(resp, "row_count", None)
-                if total_month is not None and req.offset + batch_count >= total_month:
-                    req.offset += batch_count
-                    break
+            yield b"],"
+            sum_sessions, sum_users, sum_views, sum_conv, sum_rev = totals
 
-                req.offset += batch_count
-                if sleep_ms:
-                    time.sleep(sleep_ms / 1000.0)
-
-        yield b"],"
-
-        agg = _agg_totals(client, detail_req)
-        diff = {
-            "sessions": _pct_diff(sum_sessions, agg.get("sessions", 0.0)),
-            "activeUsers": _pct_diff(sum_users, agg.get("activeUsers", 0.0)),
-            "screenPageViews": _pct_diff(sum_views, agg.get("screenPageViews", 0.0)),
-            "conversions": _pct_diff(sum_conv, agg.get("conversions", 0.0)),
-            "totalRevenue": _pct_diff(sum_rev, agg.get("totalRevenue", 0.0)),
-        }
-        tail = {
-            "rowCount": None,
-            "start": s_iso,
-            "end": e_iso,
-            "pages": pages_total,
-            "partial": False,
-            "audit": {
-                "detail_totals": {
-                    "sessions": sum_sessions,
-                    "activeUsers": sum_users,
-                    "screenPageViews": sum_views,
-                    "conversions": sum_conv,
-                    "totalRevenue": sum_rev,
-                },
-                "ga4_aggregate": agg,
-                "diff_pct": diff,
+            tail: Dict[str, Any] = {
                 "rowCount": None,
+                "start": s_iso,
+                "end": e_iso,
                 "pages": pages_total,
                 "partial": False,
-            },
-        }
-        yield _dumps(tail)
-        yield b"}"
+                "audit": None,
+            }
+            if agg_task is not None:
+                agg = await agg_task
+                diff = {
+                    "sessions": _pct_diff(sum_sessions, agg.get("sessions", 0.0)),
+                    "activeUsers": _pct_diff(sum_users, agg.get("activeUsers", 0.0)),
+                    "screenPageViews": _pct_diff(sum_views, agg.get("screenPageViews", 0.0)),
+                    "conversions": _pct_diff(sum_conv, agg.get("conversions", 0.0)),
+                    "totalRevenue": _pct_diff(sum_rev, agg.get("totalRevenue", 0.0)),
+                }
+                tail["audit"] = {
+                    "detail_totals": {
+                        "sessions": sum_sessions,
+                        "activeUsers": sum_users,
+                        "screenPageViews": sum_views,
+                        "conversions": sum_conv,
+                        "totalRevenue": sum_rev,
+                    },
+                    "ga4_aggregate": agg,
+                    "diff_pct": diff,
+                    "rowCount": None,
+                    "pages": pages_total,
+                    "partial": False,
+                }
+            # El tail aporta sus miembros al objeto abierto con '{"rows":[': se omite su '{'.
+            yield _dumps(tail)[1:]
+        finally:
+            tasks = list(pending)
+            if agg_task is not None:
+                tasks.append(agg_task)
+            await _cancel_tasks(tasks)
 
     return StreamingResponse(_gen(), media_type="application/json")
 
@@ -467,8 +695,19 @@ async def unhandled_exception_handler(_: Request, exc: Exception):
 
 # ------------------------------ Entrypoint ------------------------------------
 if __name__ == "__main__":
+    import sys
     import uvicorn
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", os.getenv("RENDER_PORT", "8000")))
+    # uvloop no existe en Windows: ahí se deja que uvicorn elija el loop.
+    loop = "uvloop" if sys.platform != "win32" else "auto"
     log.info(f"Starting server on {host}:{port}")
-    uvicorn.run("main:app", host=host, port=port, reload=os.getenv("RELOAD", "false").lower() == "true")
+    uvicorn.run(
+        "main:app",
+        host=host,
+        port=port,
+        loop=loop,
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "2")),
+        reload=os.getenv("RELOAD", "false").lower() == "true",
+    )
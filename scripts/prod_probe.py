@@ -5,6 +5,11 @@ import datetime as dt
 import requests
 import json
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson es opcional
+    orjson = None
+
 BASE_URL = os.environ.get("BASE_URL", "https://dashmarketing.onrender.com").rstrip("/")
 NO_PROXY_HOSTS = os.environ.get("NO_PROXY", "")
 DEFAULT_NO_PROXY = "localhost,127.0.0.1,.onrender.com"
@@ -37,7 +42,7 @@ def main() -> int:
     if resp.status_code != 200:
         print("exportar status", resp.status_code, file=sys.stderr)
         return 1
-    data = resp.json()
+    data = orjson.loads(resp.content) if orjson is not None else resp.json()
     assert data.get("partial") is False, f"partial flag is {data.get('partial')!r}"
     rows = data.get("rows", [])
     if not rows:
@@ -1,10 +1,20 @@
 import pathlib, sys
+
+import pytest
 from google.analytics.data_v1beta.types import RunReportRequest, DateRange, Dimension, Metric, FilterExpression, Filter
 
 sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import main
 from main import _agg_totals
 
 
+@pytest.fixture(autouse=True)
+def _clear_agg_cache():
+    main._agg_cache.clear()
+    yield
+    main._agg_cache.clear()
+
+
 class _FakeMetricValue:
     def __init__(self, value):
         self.value = str(value)
@@ -67,3 +77,24 @@ def test_agg_totals_matches_detail_sum():
     assert client.last_req.dimension_filter == detail_req.dimension_filter
     assert client.last_req.date_ranges == detail_req.date_ranges
     assert client.last_req.dimensions == []
+
+
+def test_agg_totals_cached_per_request():
+    client = _FakeClient(_FakeResp([1, 2, 3, 4, 5]))
+    detail_req = RunReportRequest(
+        property="properties/456",
+        date_ranges=[DateRange(start_date="2024-02-01", end_date="2024-02-29")],
+    )
+
+    first = _agg_totals(client, detail_req)
+    client.last_req = None
+    second = _agg_totals(client, detail_req)
+    assert second == first
+    assert client.last_req is None
+
+    other_req = RunReportRequest(
+        property="properties/456",
+        date_ranges=[DateRange(start_date="2024-03-01", end_date="2024-03-31")],
+    )
+    _agg_totals(client, other_req)
+    assert client.last_req is not None
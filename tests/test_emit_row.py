@@ -0,0 +1,33 @@
+import json, pathlib, sys
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from main import _emit_row, _DIM_NAMES, _MET_NAMES, _SUM_NAMES
+
+
+class _FakeValue:
+    def __init__(self, value):
+        self.value = value
+
+
+class _FakeRow:
+    def __init__(self, dims, mets):
+        self.dimension_values = [_FakeValue(v) for v in dims]
+        self.metric_values = [_FakeValue(v) for v in mets]
+
+
+def test_emit_row_matches_dict_serialization():
+    dims = ["20240101", "México", 'São "Paulo"', "mobile", "/", "google", "cpc", "(not set)"]
+    mets = ["5", "3", "10", "20", "0.5", "0.25", "12.5", "", "99.99"]
+    row = _FakeRow(dims, mets)
+
+    out = bytearray()
+    totals = [0.0] * len(_SUM_NAMES)
+    _emit_row(row, out, totals)
+    data = json.loads(out)
+
+    expected = {n: dims[i] for i, n in enumerate(_DIM_NAMES)}
+    for j, n in enumerate(_MET_NAMES):
+        expected[n] = float(mets[j]) if mets[j] else None
+    assert data == expected
+    assert list(data) == list(expected)
+    assert totals == [expected[n] or 0.0 for n in _SUM_NAMES]
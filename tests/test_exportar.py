@@ -0,0 +1,122 @@
+import json, pathlib, sys, time
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import main
+
+
+class _FakeValue:
+    def __init__(self, value):
+        self.value = value
+
+
+class _FakeRow:
+    def __init__(self, date, sessions="1"):
+        dims = [date] + ["x"] * (len(main._DIM_NAMES) - 1)
+        mets = ["1"] * len(main._MET_NAMES)
+        mets[main._MET_NAMES.index("sessions")] = sessions
+        self.dimension_values = [_FakeValue(v) for v in dims]
+        self.metric_values = [_FakeValue(v) for v in mets]
+
+
+class _FakeResp:
+    def __init__(self, rows, row_count):
+        self.rows = rows
+        self.row_count = row_count
+
+
+class _FakeClient:
+    """Devuelve filas por fecha de inicio del rango; las consultas sin dimensiones son la agregada."""
+
+    def __init__(self, rows_by_start, row_count=None, latency=None):
+        self.rows_by_start = rows_by_start
+        self.row_count = row_count
+        self.latency = latency or {}
+        self.agg_calls = 0
+
+    def run_report(self, req, timeout=None):
+        start = req.date_ranges[0].start_date
+        if not req.dimensions:
+            self.agg_calls += 1
+            return _FakeResp([_FakeRow(start)], 1)
+        time.sleep(self.latency.get(start, 0))
+        rows = self.rows_by_start.get(start, [])
+        total = len(rows) if self.row_count is None else self.row_count
+        return _FakeResp(rows[req.offset:], total)
+
+
+@pytest.fixture(autouse=True)
+def _clear_agg_cache():
+    main._agg_cache.clear()
+    yield
+    main._agg_cache.clear()
+
+
+def _get(monkeypatch, client, path, params):
+    monkeypatch.setattr(main, "_ga4_client", lambda: client)
+    r = TestClient(main.app).get(path, params=params)
+    assert r.status_code == 200, r.text
+    return json.loads(r.content)
+
+
+def test_exportar_mensual_emits_months_in_order(monkeypatch):
+    # Enero tarda más que abril: los meses terminan en orden inverso.
+    starts = ["2024-01-01", "2024-02-01", "2024-03-01", "2024-04-01"]
+    client = _FakeClient(
+        {
+            "2024-01-01": [_FakeRow("20240101"), _FakeRow("20240102")],
+            "2024-02-01": [],
+            "2024-03-01": [_FakeRow("20240301")],
+            "2024-04-01": [_FakeRow("20240401")],
+        },
+        latency={s: 0.05 * (len(starts) - i) for i, s in enumerate(starts)},
+    )
+    data = _get(
+        monkeypatch, client, "/exportar_mensual",
+        {"start": "2024-01-01", "end": "2024-04-30", "sleep_ms": 0},
+    )
+    assert [r["date"] for r in data["rows"]] == ["20240101", "20240102", "20240301", "20240401"]
+    assert data["pages"] == 3
+
+
+_EXPORTAR = {"from": "2024-01-01", "to": "2024-01-31"}
+
+
+def test_exportar_without_audit_skips_aggregate(monkeypatch):
+    client = _FakeClient({"2024-01-01": [_FakeRow("20240101")]})
+    data = _get(monkeypatch, client, "/exportar", _EXPORTAR)
+    assert data["audit"] is None
+    assert data["partial"] is False
+    assert client.agg_calls == 0
+
+
+def test_exportar_with_audit_returns_block(monkeypatch):
+    client = _FakeClient({"2024-01-01": [_FakeRow("20240101", sessions="3")]})
+    data = _get(monkeypatch, client, "/exportar", {**_EXPORTAR, "audit": "true"})
+    assert client.agg_calls == 1
+    assert data["audit"]["detail_totals"]["sessions"] == 3.0
+    assert data["audit"]["ga4_aggregate"]["sessions"] == 1.0
+    assert data["audit"]["partial"] is False
+
+
+def test_exportar_partial_includes_audit(monkeypatch):
+    # GA4 anuncia 5 filas pero solo entrega 1: la exportación queda parcial.
+    client = _FakeClient({"2024-01-01": [_FakeRow("20240101")]}, row_count=5)
+    data = _get(monkeypatch, client, "/exportar", _EXPORTAR)
+    assert data["partial"] is True
+    assert data["reason"] == "ga4_limit"
+    assert client.agg_calls == 1
+    assert data["audit"]["reason"] == "ga4_limit"
+
+
+def test_exportar_mensual_audit_flag(monkeypatch):
+    client = _FakeClient({"2024-01-01": [_FakeRow("20240101")]})
+    params = {"start": "2024-01-01", "end": "2024-01-31", "sleep_ms": 0}
+    assert _get(monkeypatch, client, "/exportar_mensual", params)["audit"] is None
+    assert client.agg_calls == 0
+
+    data = _get(monkeypatch, client, "/exportar_mensual", {**params, "audit": "true"})
+    assert client.agg_calls == 1
+    assert data["audit"]["detail_totals"]["sessions"] == 1.0
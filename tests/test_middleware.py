@@ -0,0 +1,54 @@
+import logging, pathlib, sys
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from main import LogRequestsASGI
+
+
+def _app() -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(LogRequestsASGI)
+
+    @app.get("/rid")
+    def rid(request: Request):
+        return {"rid": request.state.request_id}
+
+    @app.get("/broken")
+    def broken():
+        async def _gen():
+            yield b'{"rows":['
+            raise RuntimeError("GA4 retries exhausted")
+
+        return StreamingResponse(_gen(), media_type="application/json")
+
+    return app
+
+
+def test_request_id_round_trip(caplog):
+    client = TestClient(_app())
+    with caplog.at_level(logging.INFO, logger="dashmarketing"):
+        r = client.get("/rid", headers={"X-Request-ID": "abc-123"})
+    assert r.status_code == 200
+    assert r.headers["X-Request-ID"] == "abc-123"
+    assert r.json() == {"rid": "abc-123"}
+    lines = [rec.getMessage() for rec in caplog.records]
+    assert any(m.startswith("abc-123 GET /rid 200 ") and "aborted" not in m for m in lines)
+
+
+def test_request_id_generated_when_missing():
+    r = TestClient(_app()).get("/rid")
+    assert r.headers["X-Request-ID"] == r.json()["rid"]
+    assert r.json()["rid"]
+
+
+def test_stream_failing_mid_body_is_logged(caplog):
+    # Según la versión de anyio el error llega como RuntimeError o ExceptionGroup:
+    # no se propaga y se comprueba solo la línea de log.
+    client = TestClient(_app(), raise_server_exceptions=False)
+    with caplog.at_level(logging.INFO, logger="dashmarketing"):
+        client.get("/broken", headers={"X-Request-ID": "broken-1"})
+    lines = [rec.getMessage() for rec in caplog.records]
+    assert any(m.startswith("broken-1 GET /broken 200 ") and m.endswith(" aborted") for m in lines)
@@ -0,0 +1,18 @@
+import datetime as dt, pathlib, sys
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from main import _parse_date
+
+
+def test_parse_date_valid():
+    assert _parse_date("2024-02-29") == dt.date(2024, 2, 29)
+
+
+@pytest.mark.parametrize("value", ["2024-02-30", "2024-1-01", "2024/01/01", "2024-01-0a", "20240101", ""])
+def test_parse_date_invalid(value):
+    with pytest.raises(HTTPException) as exc:
+        _parse_date(value)
+    assert exc.value.status_code == 400